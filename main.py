@@ -1,63 +1,169 @@
-import datetime
+import math
 import os
 import platform
 import sys
 import time
-from queue import Queue
-from typing import List
+import wave
+from collections import deque, namedtuple
+from typing import Deque, Dict, List, Tuple
 import pygame
 import pygame._sdl2 as sdl2
-from epsound import WavFile, WavPlayer
-from PyQt5.QtCore import pyqtSignal, pyqtSlot, QRegExp, Qt, QThread, QTimer
-from PyQt5.QtGui import QIcon, QRegExpValidator
+from epsound import WavPlayer
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject, QRegExp, Qt, QTimer
+from PyQt5.QtGui import QIcon, QRegExpValidator, QTextCursor
 from PyQt5.QtWidgets import (QApplication, QComboBox, QFormLayout, QGridLayout, QGroupBox, QHBoxLayout, QLabel,
                              QLineEdit, QMainWindow, QPushButton, QTextEdit, QVBoxLayout, QWidget)
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+AUDIO_DIR = os.path.join(BASE_DIR, "audio")
 AUDIO_LIBRARIES = "epsound", "pygame"
+ICON_PATH = os.path.join(BASE_DIR, "gui", "icon.png")
+LOG_BUFFER_SIZE = 1000
+LOG_FLUSH_INTERVAL = 16
+MIXER_BUFFER_SIZE = 4096
+SOUND_FILES = sorted(os.listdir(AUDIO_DIR))
+MIXER_CHANNELS = max(8, len(SOUND_FILES))
 
+SoundEntry = namedtuple("SoundEntry", "name path duration channel")
 
-class ThreadForPlayer(QThread):
+
+def get_duration(path: str) -> float:
+    """
+    Function returns duration of WAV file reading only its header.
+    :param path: path to WAV file.
+    :return: duration in sec.
+    """
+
+    with wave.open(path, "rb") as wav_file:
+        return wav_file.getnframes() / wav_file.getframerate()
+
+
+def get_time_stamp() -> str:
     """
-    Class for thread to play sounds.
+    Function returns current local time formatted as YYYY-MM-DD HH:MM:SS:ffffff.
+    :return: time stamp.
+    """
+
+    now = time.time()
+    local_time = time.localtime(now)
+    microseconds = int((now - int(now)) * 1_000_000)
+    return (f"{local_time.tm_year:04d}-{local_time.tm_mon:02d}-{local_time.tm_mday:02d} "
+            f"{local_time.tm_hour:02d}:{local_time.tm_min:02d}:{local_time.tm_sec:02d}:{microseconds:06d}")
+
+
+def init_mixer(device: str = None):
+    """
+    Function (re)initializes pygame mixer with large buffer to avoid underruns.
+    :param device: audio device to play sounds.
+    """
+
+    pygame.mixer.quit()
+    # Forbid SDL to change format for device, so that loaded sounds keep playing correctly
+    pygame.mixer.init(devicename=device, buffer=MIXER_BUFFER_SIZE, allowedchanges=0)
+    pygame.mixer.set_num_channels(MIXER_CHANNELS)
+
+
+class Player(QObject):
+    """
+    Class to play sounds. Playback in audio libraries is non-blocking, so sounds
+    are started directly from slots and next sound waits for previous one on timer.
     """
 
     sound_played = pyqtSignal(str)
 
     def __init__(self, parent=None):
         super().__init__(parent)
-        self._finish_time: float = None
+        self._finish_monotonic: float = None
         self._index: int = 0
-        self._queue: Queue = Queue()
-        self._sound_names: List[str] = []
-        self._sounds: List[WavFile] = []
+        self._pygame_sounds_loaded: bool = False
+        self._entries: List[SoundEntry] = []
+        self._pending: Deque[Tuple[SoundEntry, str, str]] = deque()
+        self._pygame_channels: List[pygame.mixer.Channel] = []
+        self._pygame_sounds: List[pygame.mixer.Sound] = []
+        self._sound_by_name: Dict[str, SoundEntry] = {}
+        self._timer: QTimer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._play_pending_sound)
         self._wav_player: WavPlayer = WavPlayer(False)
-        self._dir_name: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio")
-        for index, file_name in enumerate(sorted(os.listdir(self._dir_name))):
-            self._sounds.append(WavFile(os.path.join(self._dir_name, file_name)))
-            self._sound_names.append(file_name)
-            self._wav_player.add_sound(os.path.join(self._dir_name, file_name), file_name)
-        pygame.init()
+        for index, file_name in enumerate(SOUND_FILES):
+            path = os.path.join(AUDIO_DIR, file_name)
+            entry = SoundEntry(file_name, path, get_duration(path), index)
+            self._entries.append(entry)
+            self._sound_by_name[file_name] = entry
+            self._wav_player.add_sound(path, file_name)
+        pygame.mixer.pre_init(44100, -16, 2, MIXER_BUFFER_SIZE)
+        # Mixer is opened at startup, not on first playback, because listing audio devices requires SDL audio
+        init_mixer()
         self.audio_devices: list = sdl2.get_audio_device_names()
-        pygame.mixer.init()
 
-    def _play_sound(self):
+    def _add_pending_sound(self, entry: SoundEntry, library: str, device: str):
+        """
+        Method adds sound to pending sounds and plays it if no sound is playing now.
+        :param entry: sound to play;
+        :param library: audio library to play sound;
+        :param device: audio device to play sound.
+        """
+
+        self._pending.append((entry, library, device))
+        if not self._timer.isActive():
+            self._play_pending_sound()
+
+    def _get_remaining_time(self) -> int:
+        """
+        Method returns time until current sound finishes.
+        :return: remaining time in msec.
+        """
+
+        if self._finish_monotonic is None:
+            return 0
+        return max(0, math.ceil(1000 * (self._finish_monotonic - time.monotonic())))
+
+    def _load_pygame_sounds(self):
+        """
+        Method loads sounds and channels for current pygame mixer.
+        """
+
+        self._pygame_channels = [pygame.mixer.Channel(entry.channel) for entry in self._entries]
+        self._pygame_sounds = [pygame.mixer.Sound(entry.path) for entry in self._entries]
+        self._pygame_sounds_loaded = True
+
+    @pyqtSlot()
+    def _play_pending_sound(self):
+        """
+        Slot plays first pending sound if current sound has finished. Otherwise
+        slot waits for current sound to finish.
+        """
+
+        if not self._pending:
+            return
+        remaining_time = self._get_remaining_time()
+        if remaining_time == 0:
+            self._play_sound(*self._pending.popleft())
+            if not self._pending:
+                return
+            remaining_time = self._get_remaining_time()
+        self._timer.start(remaining_time)
+
+    def _play_sound(self, entry: SoundEntry, library: str, device: str):
         """
         Method plays sound.
+        :param entry: sound to play;
+        :param library: audio library to play sound;
+        :param device: audio device to play sound.
         """
 
-        sound, sound_name, library, device = self._queue.get()
         if library == "pygame":
-            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio", sound_name)
-            pygame_sound = pygame.mixer.Sound(path)
-            pygame_sound.play()
+            if not self._pygame_sounds_loaded:
+                self._load_pygame_sounds()
+            self._pygame_channels[entry.channel].play(self._pygame_sounds[entry.channel])
         else:
             if device:
                 self._wav_player.set_device(device)
             else:
                 self._wav_player.remove_device()
-            self._wav_player.play(sound_name)
-        self._finish_time = time.time() + sound.duration + 0.1
-        self.sound_played.emit(sound_name)
+            self._wav_player.play(entry.name)
+        self._finish_monotonic = time.monotonic() + entry.duration + 0.1
+        self.sound_played.emit(entry.name)
 
     @pyqtSlot(str, str)
     def play_next_sound(self, library: str, device: str):
@@ -67,10 +173,9 @@ class ThreadForPlayer(QThread):
         :param device: audio device to play sound.
         """
 
-        if self._index >= len(self._sound_names):
-            self._index = 0
-        self._queue.put((self._sounds[self._index], self._sound_names[self._index], library, device))
-        self._index += 1
+        entry = self._entries[self._index]
+        self._index = (self._index + 1) % len(self._entries)
+        self._add_pending_sound(entry, library, device)
 
     @pyqtSlot(str, str, str)
     def play_sound_by_name(self, sound_name: str, library: str, device: str):
@@ -81,17 +186,29 @@ class ThreadForPlayer(QThread):
         :param device: audio device to play sound.
         """
 
-        for index, name in enumerate(self._sound_names):
-            if name == sound_name:
-                self._queue.put((self._sounds[index], sound_name, library, device))
-                break
+        entry = self._sound_by_name.get(sound_name)
+        if entry is None:
+            return
+        self._add_pending_sound(entry, library, device)
 
-    def run(self):
-        while True:
-            if not self._queue.empty() and (self._finish_time is None or time.time() > self._finish_time):
-                self._play_sound()
-            else:
-                time.sleep(0.1)
+    @property
+    def sound_names(self) -> List[str]:
+        """
+        :return: sorted list of names of sounds.
+        """
+
+        return [entry.name for entry in self._entries]
+
+    @pyqtSlot()
+    def reset_pygame_sounds(self):
+        """
+        Slot drops pygame sounds loaded for previous mixer so that they will be
+        loaded again for format of new mixer.
+        """
+
+        self._pygame_sounds_loaded = False
+        self._pygame_channels = []
+        self._pygame_sounds = []
 
     @pyqtSlot()
     def stop_current_queue(self):
@@ -99,7 +216,8 @@ class ThreadForPlayer(QThread):
         Slot stops and clears current queue of sounds.
         """
 
-        self._queue.queue.clear()
+        self._timer.stop()
+        self._pending.clear()
 
 
 class MainWindow(QMainWindow):
@@ -108,21 +226,26 @@ class MainWindow(QMainWindow):
     """
 
     certain_sound_required = pyqtSignal(str, str, str)
+    mixer_reinitialized = pyqtSignal()
     sounds_not_required = pyqtSignal()
     sounds_required = pyqtSignal(str, str)
 
-    def __init__(self, audio_devices: list):
+    def __init__(self, audio_devices: list, sound_names: List[str]):
         """
-        :param audio_devices: list of available audio devices.
+        :param audio_devices: list of available audio devices;
+        :param sound_names: list of names of sounds.
         """
 
         super().__init__()
         self.audio_devices: list = audio_devices
-        self.dir_name: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio")
+        self.sound_names: List[str] = sound_names
+        self._delay_time: int = 100
+        self._log_buf: Deque[str] = deque(maxlen=LOG_BUFFER_SIZE)
+        self._log_flush_pending: bool = False
+        self._periodic_running: bool = False
         self.timer: QTimer = QTimer()
         self.timer.timeout.connect(self.send_signal_to_play_next_sound)
-        self.timer.setInterval(100)
-        self.timer.setSingleShot(False)
+        self.timer.setSingleShot(True)
         self._init_ui()
 
     def _enable_widgets(self, status: bool = True):
@@ -136,6 +259,27 @@ class MainWindow(QMainWindow):
         self.line_edit_delay_time.setEnabled(status)
         self.button_start.setEnabled(status)
 
+    def _flush_log(self):
+        """
+        Method writes all buffered messages to text edit widget at once.
+        """
+
+        self._log_flush_pending = False
+        if not self._log_buf:
+            return
+        text = "\n".join(self._log_buf)
+        self._log_buf.clear()
+        document = self.text_edit.document()
+        if not document.isEmpty():
+            text = "\n" + text
+        scroll_bar = self.text_edit.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+        cursor = QTextCursor(document)
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        if at_bottom:
+            scroll_bar.setValue(scroll_bar.maximum())
+
     def _get_device(self) -> str:
         """
         Method returns audio device to play sound.
@@ -189,7 +333,7 @@ class MainWindow(QMainWindow):
         grid_layout = QGridLayout()
         row = 0
         column = 0
-        for file_name in sorted(os.listdir(self.dir_name)):
+        for file_name in self.sound_names:
             button = QPushButton(file_name)
             button.clicked.connect(self.play_sound_by_name)
             grid_layout.addWidget(button, row, column)
@@ -229,8 +373,7 @@ class MainWindow(QMainWindow):
         """
 
         self.setWindowTitle("AudioPlayer")
-        icon_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gui", "icon.png")
-        self.setWindowIcon(QIcon(icon_path))
+        self.setWindowIcon(QIcon(ICON_PATH))
         v_layout = QVBoxLayout()
         v_layout.addWidget(self._init_audio_libraries())
         v_layout.addWidget(self._init_buttons_for_sounds())
@@ -247,6 +390,17 @@ class MainWindow(QMainWindow):
         if self.audio_devices:
             self.set_audio_device(0)
 
+    def _log(self, message: str):
+        """
+        Method adds message to buffer that will be written to text edit widget.
+        :param message: message to write.
+        """
+
+        self._log_buf.append(message)
+        if not self._log_flush_pending:
+            self._log_flush_pending = True
+            QTimer.singleShot(LOG_FLUSH_INTERVAL, self._flush_log)
+
     @pyqtSlot()
     def play_sound_by_name(self):
         """
@@ -263,9 +417,11 @@ class MainWindow(QMainWindow):
         :param sound_name: name of sound being played.
         """
 
-        message = f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S:%f')} {sound_name}"
+        message = f"{get_time_stamp()} {sound_name}"
         print(message)
-        self.text_edit.append(message)
+        self._log(message)
+        if self._periodic_running:
+            self.timer.start(self._delay_time)
 
     @pyqtSlot()
     def send_signal_to_play_next_sound(self):
@@ -283,10 +439,11 @@ class MainWindow(QMainWindow):
         """
 
         audio_device = self.audio_devices[device_index]
-        pygame.mixer.init(devicename=audio_device)
-        message = f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S:%f')} New audio device was set: {audio_device}"
+        init_mixer(audio_device)
+        self.mixer_reinitialized.emit()
+        message = f"{get_time_stamp()} New audio device was set: {audio_device}"
         print(message)
-        self.text_edit.append(message)
+        self._log(message)
 
     @pyqtSlot(int)
     def show_audio_devices(self, library_index: int):
@@ -317,14 +474,15 @@ class MainWindow(QMainWindow):
         try:
             delay_time = int(self.line_edit_delay_time.text())
         except Exception:
-            self.text_edit.append(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S:%f')} Wrong delay time value "
-                                  f"{self.line_edit_delay_time.text()}")
+            self._log(f"{get_time_stamp()} Wrong delay time value {self.line_edit_delay_time.text()}")
             return
         self._enable_widgets(False)
-        self.text_edit.append(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S:%f')} Launched periodic player "
-                              f"with delay time {delay_time} msec")
-        self.timer.setInterval(delay_time)
-        self.timer.start()
+        self._log(f"{get_time_stamp()} Launched periodic player with delay time {delay_time} msec")
+        self._delay_time = delay_time
+        self._periodic_running = True
+        # Drop sounds left from buttons so that only periodic requests restart timer
+        self.sounds_not_required.emit()
+        self.send_signal_to_play_next_sound()
 
     @pyqtSlot()
     def stop(self):
@@ -332,6 +490,7 @@ class MainWindow(QMainWindow):
         Slot stops loop to play sound in list.
         """
 
+        self._periodic_running = False
         self.timer.stop()
         self.sounds_not_required.emit()
         self._enable_widgets()
@@ -339,12 +498,12 @@ class MainWindow(QMainWindow):
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
-    thread_for_player: ThreadForPlayer = ThreadForPlayer()
-    window = MainWindow(thread_for_player.audio_devices)
-    thread_for_player.sound_played.connect(window.print_info_about_sound, type=Qt.QueuedConnection)
-    window.certain_sound_required.connect(thread_for_player.play_sound_by_name, type=Qt.QueuedConnection)
-    window.sounds_not_required.connect(thread_for_player.stop_current_queue)
-    window.sounds_required.connect(thread_for_player.play_next_sound, type=Qt.QueuedConnection)
-    thread_for_player.start()
+    player: Player = Player()
+    window = MainWindow(player.audio_devices, player.sound_names)
+    player.sound_played.connect(window.print_info_about_sound, type=Qt.QueuedConnection)
+    window.certain_sound_required.connect(player.play_sound_by_name, type=Qt.DirectConnection)
+    window.mixer_reinitialized.connect(player.reset_pygame_sounds)
+    window.sounds_not_required.connect(player.stop_current_queue)
+    window.sounds_required.connect(player.play_next_sound, type=Qt.DirectConnection)
     window.show()
     sys.exit(app.exec_())